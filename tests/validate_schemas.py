@@ -2,202 +2,487 @@
 Test script to validate that the TypeSpec-generated schemas match nlweb_core Pydantic models.
 """
 
+import functools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import json
-import yaml
+import pickle
 from pathlib import Path
 import sys
 
-def load_typespec_schemas():
-    '''load schemas from the TypeSpec generated OpenAPI'''
-    openapi_path = Path(__file__).parent.parent / "tsp-output/openapi/openapi.yaml"
+__all__ = [
+    'load_typespec_schemas',
+    'load_pydantic_models',
+    'compare_all',
+    'validate_model',
+    'main',
+]
+
+#optional: orjson serializes dicts at C speed, used for content-hash keys
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#optional: msgspec decodes JSON bytes at C speed, used for the emitted artifacts
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+def _decode_json(raw):
+    '''decode JSON bytes, with msgspec's C decoder when it is installed'''
+    if msgspec is not None:
+        return msgspec.json.decode(raw)
+    return json.loads(raw)
+
+CACHE_DIR = Path.home() / '.cache' / 'nlweb-tsp'
+
+#the four protocol models this script validates, interned once so dict
+#lookups on them take CPython's pointer-comparison fast path
+MODEL_NAMES = tuple(sys.intern(n) for n in (
+    'AskRequest', 'AskResponse', 'WhoRequest', 'WhoResponse',
+))
+
+#hot schema keys, likewise interned ('$ref' in particular is not
+#identifier-like, so CPython does not intern it on its own)
+_REQUIRED = sys.intern('required')
+_PROPERTIES = sys.intern('properties')
+_REF = sys.intern('$ref')
+_ALL_OF = sys.intern('allOf')
+_ANY_OF = sys.intern('anyOf')
+_TYPE = sys.intern('type')
+_NULL = sys.intern('null')
+_META = sys.intern('_meta')
+_PY_META = sys.intern('meta')
+
+#per-model success lines, shared by the compiled fast path and compare_all
+#so the two paths cannot drift apart in wording
+_REQUIRED_MATCH_MSG = " {}: Required fields match"
+_PROPS_MATCH_MSG = " {}: All properties present in both"
+_TYPES_MATCH_MSG = " {}: All property types match"
+
+def _flush(out):
+    '''write the buffered report lines to stdout in a single syscall'''
+    sys.stdout.write('\n'.join(out) + '\n')
+
+def _parse_schemas(raw):
+    '''
+    parse only the components.schemas subtree of the OpenAPI doc
+
+    yaml.compose builds the lightweight node tree for the whole document,
+    but Python objects are only constructed for the schemas mapping --
+    paths, info, servers etc. are never materialized.  With ryaml
+    installed the whole doc is parsed at C speed instead, which is
+    faster still.
+
+    The YAML imports live here rather than at module top so runs that hit
+    the pickle cache or the JSON artifact never pay for them.
+    '''
+    #ryaml skips PyYAML's per-event Python objects entirely and is
+    #considerably faster again than CSafeLoader on plain scalar/map/seq docs
+    try:
+        import ryaml
+    except ImportError:
+        pass
+    else:
+        return ryaml.loads(raw.decode('utf-8'))['components']['schemas']
+
+    import yaml
+
+    #the libyaml-backed loader is much faster than the pure-Python one
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    node = yaml.compose(raw, Loader=loader)
+    for key in ('components', 'schemas'):
+        for key_node, value_node in node.value:
+            if key_node.value == key:
+                node = value_node
+                break
+        else:
+            raise KeyError(f"'{key}' not found in OpenAPI document")
+
+    return yaml.constructor.SafeConstructor().construct_mapping(node, deep=True)
+
+def _load_cached(openapi_path):
+    '''
+    parse the OpenAPI doc and return its schemas dict
+
+    Re-parsing the same YAML on every run is the slow part, so the parsed
+    schemas are cached under ~/.cache/nlweb-tsp keyed by a hash of the file
+    contents.  The cache is best-effort: any problem just falls back to a
+    fresh parse.
+    '''
+    raw = openapi_path.read_bytes()
+    cache_path = CACHE_DIR / f"{hashlib.blake2b(raw).hexdigest()}.pkl"
+
+    if cache_path.exists():
+        try:
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            pass  #stale or corrupt cache entry, re-parse below
+
+    schemas = _parse_schemas(raw)
+
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            pickle.dump(schemas, f, protocol=5)
+    except OSError:
+        pass
+
+    return schemas
+
+def load_typespec_schemas(out):
+    '''
+    load schemas from the TypeSpec generated OpenAPI, reporting into out
+
+    Fastest first: per-model JSON files from the @typespec/json-schema
+    emitter (emit with '--option "@typespec/json-schema.file-type=json"'),
+    then a JSON OpenAPI artifact (emit with
+    '--option "@typespec/openapi3.file-type=json"'), then the YAML
+    artifact.  The JSON paths skip YAML parsing entirely and decode with
+    msgspec's C decoder when it is installed.
+    '''
+    tsp_output = Path(__file__).parent.parent / "tsp-output"
+
+    json_schema_dir = tsp_output / "json-schema"
+    if json_schema_dir.is_dir():
+        schemas = {
+            path.stem: _decode_json(path.read_bytes())
+            for path in json_schema_dir.glob("*.json")
+        }
+        if schemas:
+            return schemas
+
+    output_dir = tsp_output / "openapi"
+    json_path = output_dir / "openapi.json"
+
+    if json_path.exists():
+        return _decode_json(json_path.read_bytes())['components']['schemas']
+
+    openapi_path = output_dir / "openapi.yaml"
 
     if not openapi_path.exists():
-        print("ERROR: OpenAPI schema not found. Run 'npx tsp compile .' first")
+        out.append("ERROR: OpenAPI schema not found. Run 'npx tsp compile .' first")
+        _flush(out)
         sys.exit(1)
 
-    with open(openapi_path) as f:
-        openapi = yaml.safe_load(f)
+    return _load_cached(openapi_path)
 
-    return openapi['components']['schemas']
+@functools.cache
+def _pyd_schema(name):
+    '''build the JSON schema for one nlweb_core model, memoized per process
 
-def load_pydantic_schemas():
+    model_json_schema() walks Pydantic's core schema and is the expensive
+    step here, so repeated in-process calls reuse the first result.
     '''
-    load schemas from the nlweb_core Pydantic models
-    
-    This assumes that nlweb_core is installed or available in the path
+    from nlweb_core.protocol import models
+    return getattr(models, name).model_json_schema()
+
+def load_pydantic_models(out):
+    '''
+    load the nlweb_core Pydantic model classes, reporting into out
+
+    This assumes that nlweb_core is installed or available in the path.
+    Only the classes are collected here; the (expensive) JSON schema for a
+    model is built by _pyd_schema once validate_model knows the model also
+    exists on the TypeSpec side.
     '''
     try:
         from nlweb_core.protocol import models
     except ImportError:
-        print("ERROR: nlweb_core not found.  Install it first.")
-        print("     pip install git+https://github.com/nlweb-ai/nlweb_core.git")
+        out.append("ERROR: nlweb_core not found.  Install it first.")
+        out.append("     pip install git+https://github.com/nlweb-ai/nlweb_core.git")
+        _flush(out)
         sys.exit(1)
 
-    schemas = {}
-    
+    classes = {}
+
     #try to load each model, skip if it doesn't exist
-    model_names = ['AskRequest', 'AskResponse', 'WhoRequest', 'WhoResponse']
+    #unrolled -- the model list is a fixed 4-element constant
+    if hasattr(models, 'AskRequest'):
+        classes['AskRequest'] = models.AskRequest
+    else:
+        out.append(" AskRequest not found in nlweb_core")
 
-    for model_name in model_names:
-        if hasattr(models, model_name):
-            model_class = getattr(models, model_name)
-            schemas[model_name] = model_class.model_json_schema()
-        else:
-            print(f" {model_name} not found in nlweb_core")
+    if hasattr(models, 'AskResponse'):
+        classes['AskResponse'] = models.AskResponse
+    else:
+        out.append(" AskResponse not found in nlweb_core")
 
-    return schemas
+    if hasattr(models, 'WhoRequest'):
+        classes['WhoRequest'] = models.WhoRequest
+    else:
+        out.append(" WhoRequest not found in nlweb_core")
 
-def compare_required_fields(typespec_schema, pydantic_schema, model_name):
-    '''check that required fields match'''
-    ts_required = set(typespec_schema.get('required', []))
-    py_required = set(pydantic_schema.get('required', []))
+    if hasattr(models, 'WhoResponse'):
+        classes['WhoResponse'] = models.WhoResponse
+    else:
+        out.append(" WhoResponse not found in nlweb_core")
+
+    return classes
+
+def _has_ref(prop):
+    """Check if a property references another schema"""
+    # Direct $ref
+    if _REF in prop:
+        return True
+    # Inside allOf (any() stops at the first $ref found)
+    all_of = prop.get(_ALL_OF)
+    if all_of and any(_REF in item for item in all_of):
+        return True
+    # Inside anyOf (check for $ref in any item that's not null)
+    any_of = prop.get(_ANY_OF)
+    return bool(any_of) and any(
+        _REF in item for item in any_of if item.get(_TYPE) != _NULL
+    )
+
+def _dict_digest(obj):
+    '''
+    stable BLAKE2b digest of a parsed schema dict
 
-    #handle _meta vs meta naming
-    if '_meta' in ts_required and 'meta' in py_required:
-        py_required.remove('meta')
-        py_required.add('_meta')
+    Used as a content-hash cache key for anything derived from a schema.
+    orjson encodes the dict at C speed when installed; the stdlib json
+    dump with sorted keys is the (much slower) fallback.
+    '''
+    if orjson is not None:
+        payload = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    else:
+        payload = json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.blake2b(payload).hexdigest()
 
-    if ts_required != py_required:
-        print(f" {model_name}: Required fields mismatch")
-        print(f" TypeSpec: {ts_required}")
-        print(f" Pydantic: {py_required}")
+#codegen'd fast-path validators, keyed by (model name, schema digest) so a
+#changed TypeSpec schema never reuses a stale validator (see _compile_validator)
+_COMPILED = {}
 
-    print(f" {model_name}: Required fields match")
-    return True
+def _compile_validator(model_name, typespec_schema):
+    '''
+    compile a straight-line fast-path check for one model
+
+    The generated function hard-codes the model's required set, property
+    names and per-property ref/non-ref classification from the TypeSpec
+    schema, so the everything-matches case runs without traversing the
+    TypeSpec side at all.  It covers exactly the checks compare_all makes,
+    which stays as the slow path producing the diagnostics whenever the
+    fast path reports a mismatch.
+    '''
+    ts_required = set(typespec_schema.get(_REQUIRED, ()))
+    ts_prop_map = typespec_schema.get(_PROPERTIES, {})
+    ts_props = set(ts_prop_map)
+
+    #bake the _meta/meta rename decision in at compile time
+    required_src = "frozenset(py.get('required', ()))"
+    if _META in ts_required:
+        required_src = ("frozenset('_meta' if f == 'meta' else f"
+                        " for f in py.get('required', ()))")
+
+    props_src = "frozenset(props)"
+    if _META in ts_props:
+        props_src = "frozenset('_meta' if p == 'meta' else p for p in props)"
+
+    lines = [
+        "def _v(py):",
+        "    props = py.get('properties', {})",
+        f"    if {required_src} != {ts_required!r}:",
+        "        return False",
+        f"    if {props_src} != {ts_props!r}:",
+        "        return False",
+    ]
+
+    #one hard-coded ref/non-ref check per property, mirroring compare_all's
+    #type comparison (including the _meta fallback to Pydantic's meta)
+    for prop_name, ts_prop in ts_prop_map.items():
+        if prop_name == _META:
+            lines.append("    prop = props.get('_meta')")
+            lines.append("    if prop is None:")
+            lines.append("        prop = props['meta']")
+            access = "prop"
+        else:
+            access = f"props[{prop_name!r}]"
+        test = "not _has_ref" if _has_ref(ts_prop) else "_has_ref"
+        lines.append(f"    if {test}({access}):")
+        lines.append("        return False")
 
-def compare_properties(typespec_schema, pydantic_schema, model_name):
-    '''check that properties exist in both'''
-    ts_props = set(typespec_schema.get('properties', {}).keys())
-    py_props = set(pydantic_schema.get('properties', {}).keys())
+    lines.append("    return True")
 
-    #handle _meta vs meta naming
-    if '_meta' in ts_props and 'meta' in py_props:
-        py_props.remove('meta')
-        py_props.add('_meta')
+    namespace = {'_has_ref': _has_ref}
+    exec(compile('\n'.join(lines) + '\n', f"<validator:{model_name}>", 'exec'), namespace)
+    return namespace['_v']
 
-    missing_in_pydantic = ts_props - py_props
-    missing_in_typespec = py_props - ts_props
+def compare_all(typespec_schema, pydantic_schema, model_name, out):
+    '''
+    run the required-fields, properties and property-types checks in one pass
 
-    issues = False
+    The three checks share the same schema reads and the _meta/meta rename,
+    so they are fused: each schema is read once and the rename applied once.
+    Report lines are appended to out rather than printed, so the whole run
+    is flushed to stdout in a single write.  Returns a (required_match,
+    props_match, types_match) tuple.
+    '''
+    ts_required = frozenset(typespec_schema.get(_REQUIRED, ()))
+    ts_prop_map = typespec_schema.get(_PROPERTIES, {})
+    py_prop_map = pydantic_schema.get(_PROPERTIES, {})
+    ts_props = frozenset(ts_prop_map)
+
+    #handle _meta vs meta naming while building the sets, no mutate-after-build
+    py_required = frozenset(
+        _META if f == _PY_META and _META in ts_required else f
+        for f in pydantic_schema.get(_REQUIRED, ())
+    )
+    py_props = frozenset(
+        _META if p == _PY_META and _META in ts_props else p
+        for p in py_prop_map
+    )
+
+    #required fields
+    required_match = ts_required == py_required
+
+    if required_match:
+        out.append(_REQUIRED_MATCH_MSG.format(model_name))
+    else:
+        out.append(f" {model_name}: Required fields mismatch")
+        out.append(f" TypeSpec: {set(ts_required)}")
+        out.append(f" Pydantic: {set(py_required)}")
+
+    #properties exist in both: hash each key once into the intersection,
+    #then the two "missing" diffs are cheap subtractions against it
+    common = ts_props & py_props
+    missing_in_pydantic = ts_props - common
+    missing_in_typespec = py_props - common
 
     if missing_in_pydantic:
-        print(f" {model_name}: Properties in TypeSpec but not Pydantic:  {missing_in_pydantic}")
-        issues = True
+        out.append(f" {model_name}: Properties in TypeSpec but not Pydantic:  {set(missing_in_pydantic)}")
 
     if missing_in_typespec:
-        print(f" {model_name}: Properties in Pydantic but not in TypeSpec: {missing_in_typespec}")
-        issues = True
+        out.append(f" {model_name}: Properties in Pydantic but not in TypeSpec: {set(missing_in_typespec)}")
 
-    if not issues:
-        print(f" {model_name}: All properties present in both")
-    
-    return not issues
+    props_match = not (missing_in_pydantic or missing_in_typespec)
 
-def compare_property_types(typespec_schema, pydantic_schema, model_name, schemas_dict):
-    '''Check that property types match, including nested structures'''
-    ts_props = typespec_schema.get('properties', {})
-    py_props = pydantic_schema.get('properties', {})
-    
+    if props_match:
+        out.append(_PROPS_MATCH_MSG.format(model_name))
+
+    #property types: a reference to another schema on one side but not the
+    #other means the types diverge
     issues = []
-    
-    for prop_name in ts_props.keys():
-        if prop_name not in py_props:
-            continue  # Already caught by compare_properties
-        
-        ts_prop = ts_props[prop_name]
-        py_prop = py_props[prop_name]
-        
-        # Check if one is a reference to another schema
-        def has_ref(prop):
-            """Check if a property references another schema"""
-            # Direct $ref
-            if prop.get('$ref'):
-                return True
-            # Inside allOf
-            if prop.get('allOf'):
-                return any(item.get('$ref') for item in prop.get('allOf', []))
-            # Inside anyOf (check for $ref in any item that's not null)
-            if prop.get('anyOf'):
-                return any(
-                    item.get('$ref') 
-                    for item in prop.get('anyOf', []) 
-                    if item.get('type') != 'null'
-                )
-            return False
-        
-        ts_has_ref = has_ref(ts_prop)
-        py_has_ref = has_ref(py_prop)
-        
+
+    for prop_name, ts_prop in ts_prop_map.items():
+        py_prop = py_prop_map.get(prop_name)
+        if py_prop is None and prop_name == _META:
+            py_prop = py_prop_map.get(_PY_META)
+        if py_prop is None:
+            continue  # Already caught by the properties check
+
+        ts_has_ref = _has_ref(ts_prop)
+        py_has_ref = _has_ref(py_prop)
+
+        if ts_has_ref != py_has_ref:
+            issues.append(f"   {prop_name}: schema reference in "
+                          f"{'TypeSpec' if ts_has_ref else 'Pydantic'} only")
+
     if issues:
-        print(f" {model_name}: Type mismatches found:")
-        for issue in issues:
-            print(issue)
-        return False
-    
-    print(f" {model_name}: All property types match")
-    return True
+        out.append(f" {model_name}: Type mismatches found:")
+        out.extend(issues)
+        types_match = False
+    else:
+        out.append(_TYPES_MATCH_MSG.format(model_name))
+        types_match = True
 
+    return required_match, props_match, types_match
+
+
+def validate_model(model_name, typespec_schemas, pydantic_models, out):
+    """Validate a single model, appending report lines to out"""
+    out.append(f" Validating {model_name}...")
 
-def validate_model(model_name, typespec_schemas, pydantic_schemas):
-    """Validate a single model"""
-    print(f" Validating {model_name}...")
-    
     if model_name not in typespec_schemas:
-        print(f" {model_name} not found in TypeSpec schemas")
+        out.append(f" {model_name} not found in TypeSpec schemas")
         return None  # Neither pass nor fail - just not applicable
-    
-    if model_name not in pydantic_schemas:
-        print(f" {model_name} not yet implemented in nlweb_core - skipping")
+
+    if model_name not in pydantic_models:
+        out.append(f" {model_name} not yet implemented in nlweb_core - skipping")
         return None  # Not implemented yet - not a failure
-    
+
+    #only now is the Pydantic JSON schema worth building (and it is memoized)
     ts_schema = typespec_schemas[model_name]
-    py_schema = pydantic_schemas[model_name]
-    
-    required_match = compare_required_fields(ts_schema, py_schema, model_name)
-    props_match = compare_properties(ts_schema, py_schema, model_name)
-    types_match = compare_property_types(ts_schema, py_schema, model_name, typespec_schemas)
+    py_schema = _pyd_schema(model_name)
 
-    return required_match and props_match and types_match
+    #fast path: a compiled validator with the expected sets as literals
+    cache_key = (model_name, _dict_digest(ts_schema))
+    validator = _COMPILED.get(cache_key)
+    if validator is None:
+        validator = _COMPILED[cache_key] = _compile_validator(model_name, ts_schema)
 
-def main():
-    print("=" * 60)
-    print("NLWeb Protocol Validation")
-    print("Comparing TypeSpec specification with nlweb_core implementation")
-    print("=" * 60)
+    if validator(py_schema):
+        out.append(_REQUIRED_MATCH_MSG.format(model_name))
+        out.append(_PROPS_MATCH_MSG.format(model_name))
+        out.append(_TYPES_MATCH_MSG.format(model_name))
+        return True
 
-    #Load schemas
-    typespec_schemas = load_typespec_schemas()
-    pydantic_schemas = load_pydantic_schemas()
+    #slow path: full comparison with diagnostics
+    required_match, props_match, types_match = compare_all(ts_schema, py_schema, model_name, out)
 
-    print(f" TypeSpec models: {len(typespec_schemas)}")
-    print(f" Pydantic models: {len(pydantic_schemas)}")
+    return required_match and props_match and types_match
 
-    #validate each main model
-    models_to_validate = ['AskRequest', 'AskResponse', 'WhoRequest', 'WhoResponse']
+def main():
+    #report lines are buffered and written to stdout in one syscall at the end
+    out = []
+    out.append("=" * 60)
+    out.append("NLWeb Protocol Validation")
+    out.append("Comparing TypeSpec specification with nlweb_core implementation")
+    out.append("=" * 60)
+
+    #Load the TypeSpec schemas and the Pydantic model classes; on a fatal
+    #load error they flush the buffer themselves before exiting
+    typespec_schemas = load_typespec_schemas(out)
+    pydantic_models = load_pydantic_models(out)
+
+    out.append(f" TypeSpec models: {len(typespec_schemas)}")
+    out.append(f" Pydantic models: {len(pydantic_models)}")
+
+    #validate the models in parallel -- they share no mutable state, each
+    #worker writes to its own line buffer so the report stays in order
+    def _run(model_name):
+        lines = []
+        return validate_model(model_name, typespec_schemas, pydantic_models, lines), lines
+
+    with ThreadPoolExecutor(max_workers=len(MODEL_NAMES)) as executor:
+        outcomes = list(executor.map(_run, MODEL_NAMES))
 
     results = {}
-    for model_name in models_to_validate:
-        results[model_name] = validate_model(model_name, typespec_schemas, pydantic_schemas)
+    for model_name, (passed, lines) in zip(MODEL_NAMES, outcomes):
+        results[model_name] = passed
+        out.extend(lines)
 
     # Summary
-    print("\n" + "+" * 60)
-    print("SUMMARY")
-    print("+" * 60)
-    
-    all_passed = all(results.values())
+    out.append("\n" + "+" * 60)
+    out.append("SUMMARY")
+    out.append("+" * 60)
+
+    #one pass over the results: None means "not applicable", not a failure
+    all_passed = True
 
     for model_name, passed in results.items():
-        status = "PASS" if passed else "FAIL"
-        print(f"{status}: {model_name}")
+        if passed is None:
+            status = "SKIP"
+        elif passed:
+            status = "PASS"
+        else:
+            status = "FAIL"
+            all_passed = False
+        out.append(f"{status}: {model_name}")
 
-    print("=" * 60)
+    out.append("=" * 60)
 
     if all_passed:
-        print("All validation passed! Spec and implementation match.")
-        return 0
+        out.append("All validation passed! Spec and implementation match.")
+        exit_code = 0
     else:
-        print("Some validations failed. Please review the differences")
-        return 1
+        out.append("Some validations failed. Please review the differences")
+        exit_code = 1
+
+    _flush(out)
+    return exit_code
     
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file